@@ -0,0 +1,31 @@
+"""
+build_index.py
+Builds the banned-generics index used by the demo web app:
+- Reads the train/test dataset CSVs
+- Writes output/banned_index.pkl (deduplicated, pre-normalized)
+
+Run after generate_demo_dataset.py.
+"""
+
+import os
+
+from ocr_matcher import load_banned_generics, save_banned_generics_index
+
+# ------------------ CONFIG ------------------
+OUT_DIR = "output"
+DATA_CSVS = [
+    os.path.join(OUT_DIR, "train", "train_dataset.csv"),
+    os.path.join(OUT_DIR, "test", "test_dataset.csv"),
+]
+INDEX_PATH = os.path.join(OUT_DIR, "banned_index.pkl")
+
+# ------------------ MAIN ------------------
+def main():
+    banned_generics = load_banned_generics(DATA_CSVS)
+    save_banned_generics_index(banned_generics, INDEX_PATH)
+
+    print(f"Indexed {len(banned_generics)} banned generics")
+    print("Index file:", os.path.abspath(INDEX_PATH))
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 
 import os
 import sys
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------- PATH FIX ----------
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -9,11 +12,16 @@ if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 # ----------------------------
 
-from flask import Flask, request, render_template, redirect, url_for, flash
+from flask import Flask, Request, request, render_template, redirect, url_for, flash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
-from ocr_matcher import process_invoice
+from ocr_matcher import (
+    process_invoice_bytes,
+    load_banned_generics,
+    load_banned_generics_index,
+    build_banned_index,
+)
 
 load_dotenv()
 
@@ -23,8 +31,24 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {"pdf", "png", "jpg", "jpeg", "tiff"}
 
+# Uploads are parsed straight into memory, so cap their size
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+
+
+class InMemoryUploadRequest(Request):
+    """
+    Parses multipart file parts into a BytesIO instead of werkzeug's spooled
+    temp file, so the pipeline works on the bytes read off the socket
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
+
 app = Flask(__name__, template_folder="templates")
+app.request_class = InMemoryUploadRequest
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 app.secret_key = "drug-inspector-demo"
 
 # ---------- DATASET PATHS ----------
@@ -33,11 +57,84 @@ DATA_CSVS = [
     os.path.join(PROJECT_ROOT, "output", "test", "test_dataset.csv"),
 ]
 
+# ---------- BANNED INDEX (built once, rebuilt on CSV change) ----------
+_banned_lock = threading.Lock()
+_banned_state = {"mtimes": None, "index": None}
+
+
+# Written by build_index.py; used when it is newer than every CSV
+BANNED_INDEX_PATH = os.path.join(PROJECT_ROOT, "output", "banned_index.pkl")
+
+
+def _mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def _dataset_mtimes():
+    return tuple(_mtime(p) for p in DATA_CSVS + [BANNED_INDEX_PATH])
+
+
+def _load_banned_generics():
+    index_mtime = _mtime(BANNED_INDEX_PATH)
+    csv_mtimes = [m for m in map(_mtime, DATA_CSVS) if m is not None]
+    if index_mtime is not None and index_mtime >= max(csv_mtimes, default=0):
+        return load_banned_generics_index(BANNED_INDEX_PATH)
+    return load_banned_generics(DATA_CSVS)
+
+
+def get_banned_index():
+    mtimes = _dataset_mtimes()
+    with _banned_lock:
+        if mtimes != _banned_state["mtimes"]:
+            _banned_state["index"] = build_banned_index(_load_banned_generics())
+            _banned_state["mtimes"] = mtimes
+        return _banned_state["index"]
+
+
+get_banned_index()
+
 # ---------- HELPERS ----------
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# Uploads are archived to disk off the request thread; the pipeline works
+# on the in-memory bytes and never waits for the write. The backlog is
+# bounded so pending uploads cannot pile up in memory; once it is full the
+# request writes its own copy inline.
+MAX_PENDING_WRITES = 8
+
+_upload_writer = ThreadPoolExecutor(max_workers=1)
+_pending_writes = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+
+
+def _write_file(file_path, data):
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+
+def _write_done(fut, file_path):
+    _pending_writes.release()
+    if fut.exception() is not None:
+        app.logger.error("Saving upload %s failed: %s", file_path, fut.exception())
+
+
+def save_upload(data, file_path):
+    """
+    Queues the disk copy of an upload in the background, or writes it
+    inline when the write backlog is full
+    """
+    if not _pending_writes.acquire(blocking=False):
+        try:
+            _write_file(file_path, data)
+        except OSError as e:
+            app.logger.error("Saving upload %s failed: %s", file_path, e)
+        return
+
+    fut = _upload_writer.submit(_write_file, file_path, data)
+    fut.add_done_callback(lambda f: _write_done(f, file_path))
+
+
 # ---------- ROUTES ----------
 @app.route("/")
 def index():
@@ -67,13 +164,14 @@ def upload():
 
     filename = secure_filename(file.filename)
     file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    file.save(file_path)
+    file_bytes = file.stream.getvalue()
+    save_upload(file_bytes, file_path)
 
     try:
         # ---------- FULL OCR + MATCH PIPELINE ----------
-        result = process_invoice(
-            pdf_path=file_path,
-            dataset_csvs=DATA_CSVS
+        result = process_invoice_bytes(
+            pdf_bytes=file_bytes,
+            banned_index=get_banned_index()
         )
 
         return render_template(
@@ -5,18 +5,20 @@ Generates demo dataset:
 - Test invoices (PDF + CSV + JSON)
 """
 
+import io
 import os
-import random
 import csv
-import json
 import string
 import shutil
+from multiprocessing import Pool
 from datetime import datetime, timedelta
 
+import numpy as np
+import orjson
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.cidfonts import UnicodeCIDFont
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
-from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.graphics.barcode import code128
 
@@ -27,31 +29,44 @@ OUT_DIR = "output"
 TRAIN_DIR = os.path.join(OUT_DIR, "train")
 TEST_DIR = os.path.join(OUT_DIR, "test")
 
-# ------------------ PREP FOLDERS ------------------
-if os.path.exists(OUT_DIR):
-    shutil.rmtree(OUT_DIR)
+GST_RATES = [5, 12, 18]
+BATCH_CHARS = np.array(list(string.ascii_uppercase + string.digits))
+DOCTOR_DIGITS = np.array(list(string.digits))
 
-os.makedirs(TRAIN_DIR, exist_ok=True)
-os.makedirs(TEST_DIR, exist_ok=True)
+# Set to an int to regenerate the exact same dataset
+SEED = None
 
-# ------------------ FONTS / STYLES ------------------
-styles = getSampleStyleSheet()
+# ------------------ FONTS / LAYOUT ------------------
+FONT_NAME = "Helvetica"
 
 try:
     pdfmetrics.registerFont(UnicodeCIDFont("HeiseiMin-W3"))
-    styles["Normal"].fontName = "HeiseiMin-W3"
-    styles["Title"].fontName = "HeiseiMin-W3"
+    FONT_NAME = "HeiseiMin-W3"
 except:
     pass  # safe fallback
 
+PAGE_WIDTH, PAGE_HEIGHT = letter
+MARGIN = 72
+LINE_HEIGHT = 12  # 10pt body text
+
+# Same fonts and sizes the Platypus layout used: Table default and
+# Heading2 are Helvetica, body and title text use FONT_NAME
+TABLE_FONT = "Helvetica"
+TABLE_FONT_SIZE = 10
+TABLE_ROW_HEIGHT = 18
+TABLE_MARGIN = 48
+COL_GAP = 6
+TABLE_HEADER = ["#", "Brand", "Generic", "Strength", "Batch", "Qty", "MRP", "GST%", "Line Total"]
+
 # ------------------ UTILITIES ------------------
 def format_inr(x):
     """Format number as INR currency."""
     return f"₹{x:,.2f}"
 
-def random_batch():
-    """Generate a random batch number."""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+def random_batches(rng, n):
+    """Generate n random batch numbers."""
+    chars = rng.choice(BATCH_CHARS, size=(n, 8))
+    return [''.join(row) for row in chars]
 
 # ------------------ FIXED DRUG POOL ------------------
 drug_pool = [
@@ -76,32 +91,60 @@ pharmacies = [
 ]
 
 # ------------------ PDF GENERATION ------------------
+def column_offsets():
+    """Left x of each table column, sized to the widest possible cell."""
+    widest = [
+        ["4"],
+        [d[0] for d in drug_pool],
+        [d[1] for d in drug_pool],
+        [d[2] for d in drug_pool],
+        ["W" * 8],
+        ["3"],
+        [format_inr(400)],
+        ["18%"],
+        [format_inr(400 * 3 * 1.18)],
+    ]
+    offsets = []
+    x = TABLE_MARGIN
+    for header, cells in zip(TABLE_HEADER, widest):
+        offsets.append(x)
+        x += max(stringWidth(t, TABLE_FONT, TABLE_FONT_SIZE) for t in [header] + cells) + COL_GAP
+    return offsets
+
+# Every invoice shares one template, so column offsets are fixed
+COL_X = column_offsets()
+
 def write_invoice(pdf_path, inv_id, pharmacy, date, doctor_id, items):
-    doc = SimpleDocTemplate(pdf_path, pagesize=letter)
-    story = []
-
-    # Header
-    header_html = (
-        f"<b>{pharmacy}</b><br/>"
-        f"GSTIN: 32ABCDE1234F1Z<br/>"
-        f"Address: Kochi, Kerala<br/>"
-        f"Doctor Prescription: {doctor_id}<br/>"
-    )
-    story.append(Paragraph(header_html, styles["Title"]))
-    story.append(Spacer(1, 8))
+    c = canvas.Canvas(pdf_path, pagesize=letter)
+    y = PAGE_HEIGHT - MARGIN
+
+    # Header (Title style: 18pt, 22pt leading)
+    c.setFont(FONT_NAME, 18)
+    header_lines = [
+        pharmacy,
+        "GSTIN: 32ABCDE1234F1Z",
+        "Address: Kochi, Kerala",
+        f"Doctor Prescription: {doctor_id}",
+    ]
+    for line in header_lines:
+        c.drawCentredString(PAGE_WIDTH / 2, y, line)
+        y -= 22
+    y -= 8
 
-    story.append(Paragraph(f"<b>Invoice No:</b> {inv_id}<br/><b>Date:</b> {date.strftime('%d-%m-%Y')}", styles["Normal"]))
-    story.append(Spacer(1, 8))
+    c.setFont(FONT_NAME, 10)
+    c.drawString(MARGIN, y, f"Invoice No: {inv_id}")
+    y -= LINE_HEIGHT
+    c.drawString(MARGIN, y, f"Date: {date.strftime('%d-%m-%Y')}")
+    y -= LINE_HEIGHT + 8
 
     # Barcode
     barcode = code128.Code128(inv_id, barHeight=30)
-    story.append(barcode)
-    story.append(Spacer(1, 8))
+    y -= barcode.height
+    barcode.drawOn(c, MARGIN, y)
+    y -= TABLE_ROW_HEIGHT + 8
 
-    # Table structure
-    table_data = [
-        ["#", "Brand", "Generic", "Strength", "Batch", "Qty", "MRP", "GST%", "Line Total"]
-    ]
+    # Table
+    table_data = [TABLE_HEADER]
 
     for idx, it in enumerate(items, start=1):
         table_data.append([
@@ -116,52 +159,90 @@ def write_invoice(pdf_path, inv_id, pharmacy, date, doctor_id, items):
             format_inr(it["line_total"]),
         ])
 
-    table = Table(table_data, hAlign="LEFT")
-    story.append(table)
-    story.append(Spacer(1, 10))
+    c.setFont(TABLE_FONT, TABLE_FONT_SIZE)
+    for row in table_data:
+        for x, cell in zip(COL_X, row):
+            c.drawString(x, y, str(cell))
+        y -= TABLE_ROW_HEIGHT
+    y -= 10
 
     total_amount = sum(it["line_total"] for it in items)
     total_gst = sum(it["gst_amount"] for it in items)
 
-    story.append(Paragraph(f"<b>Grand Total: {format_inr(total_amount)}</b>", styles["Heading2"]))
-    story.append(Paragraph(f"GST Total: {format_inr(total_gst)}", styles["Normal"]))
-
-    story.append(Spacer(1, 12))
-    story.append(Paragraph("<i>Authorized Signature</i><br/>_________________", styles["Normal"]))
+    # Heading2 style
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(MARGIN, y, f"Grand Total: {format_inr(total_amount)}")
+    y -= 18
+    c.setFont(FONT_NAME, 10)
+    c.drawString(MARGIN, y, f"GST Total: {format_inr(total_gst)}")
+    y -= LINE_HEIGHT + 12
+
+    c.drawString(MARGIN, y, "Authorized Signature")
+    y -= LINE_HEIGHT
+    c.drawString(MARGIN, y, "_________________")
+
+    c.showPage()
+    c.save()
+
+# ------------------ SAMPLE INVOICES ------------------
+def sample_invoices(prefix, count, outdir, rng):
+    """
+    Draw every random value for a split in one batch of array calls, then
+    slice it per invoice. Returns generate_invoice argument tuples.
+    """
+    # Per-invoice draws
+    n_items = rng.integers(2, 5, size=count)
+    pharmacy_idx = rng.integers(0, len(pharmacies), size=count)
+    days_ago = rng.integers(1, 366, size=count)
+    doctor_digits = rng.choice(DOCTOR_DIGITS, size=(count, 6))
+
+    # Per-line-item draws across the whole split
+    total_items = int(n_items.sum())
+    drug_idx = rng.integers(0, len(drug_pool), size=total_items)
+    qty = rng.integers(1, 4, size=total_items)
+    price = np.round(rng.uniform(30, 400, size=total_items), 2)
+    gst = rng.choice(GST_RATES, size=total_items)
+
+    gst_amount = price * qty * gst / 100
+    line_total = price * qty + gst_amount
+
+    items = [
+        {
+            "brand": drug_pool[d][0],
+            "generic": drug_pool[d][1],
+            "strength": drug_pool[d][2],
+            "qty": q,
+            "price": p,
+            "gst": g,
+            "gst_amount": ga,
+            "line_total": lt,
+            "batch": batch,
+            "is_banned": drug_pool[d][3]
+        }
+        for d, q, p, g, ga, lt, batch in zip(
+            drug_idx.tolist(), qty.tolist(), price.tolist(), gst.tolist(),
+            gst_amount.tolist(), line_total.tolist(), random_batches(rng, total_items)
+        )
+    ]
 
-    doc.build(story)
+    now = datetime.now()
+    ends = np.cumsum(n_items).tolist()
+    starts = [0] + ends[:-1]
+
+    return [
+        (
+            f"{prefix}-{i+1:04d}",
+            outdir,
+            pharmacies[pharmacy_idx[i]],
+            now - timedelta(days=int(days_ago[i])),
+            "DR-" + ''.join(doctor_digits[i]),
+            items[start:end],
+        )
+        for i, (start, end) in enumerate(zip(starts, ends))
+    ]
 
 # ------------------ GENERATE INVOICE ------------------
-def generate_invoice(inv_id, outdir):
-    pharmacy = random.choice(pharmacies)
-    date = datetime.now() - timedelta(days=random.randint(1, 365))
-    doctor_id = "DR-" + ''.join(random.choices(string.digits, k=6))
-
-    n_items = random.randint(2, 4)
-    items = []
-
-    for _ in range(n_items):
-        brand, generic, strength, is_banned = random.choice(drug_pool)
-        qty = random.randint(1, 3)
-        price = round(random.uniform(30, 400), 2)
-        gst = random.choice([5, 12, 18])
-
-        gst_amount = price * qty * gst / 100
-        line_total = price * qty + gst_amount
-
-        items.append({
-            "brand": brand,
-            "generic": generic,
-            "strength": strength,
-            "qty": qty,
-            "price": price,
-            "gst": gst,
-            "gst_amount": gst_amount,
-            "line_total": line_total,
-            "batch": random_batch(),
-            "is_banned": is_banned
-        })
-
+def generate_invoice(inv_id, outdir, pharmacy, date, doctor_id, items):
     pdf_path = os.path.join(outdir, f"{inv_id}.pdf")
     write_invoice(pdf_path, inv_id, pharmacy, date, doctor_id, items)
 
@@ -175,46 +256,68 @@ def generate_invoice(inv_id, outdir):
     }
 
 # ------------------ SAVE DATASET ------------------
+CSV_HEADER = ["invoice_id", "pdf", "pharmacy", "date", "doctor", "brand",
+              "generic", "strength", "batch", "qty", "price", "gst",
+              "line_total", "is_banned"]
+
 def save_dataset(records, outdir, name):
     json_path = os.path.join(outdir, f"{name}.json")
     csv_path = os.path.join(outdir, f"{name}.csv")
 
-    with open(json_path, "w", encoding="utf-8") as jf, open(csv_path, "w", newline="", encoding="utf-8") as cf:
-        json.dump(records, jf, indent=2, ensure_ascii=False)
-
-        writer = csv.writer(cf)
-        writer.writerow(["invoice_id", "pdf", "pharmacy", "date", "doctor", "brand",
-                         "generic", "strength", "batch", "qty", "price", "gst",
-                         "line_total", "is_banned"])
-
-        for rec in records:
-            for item in rec["items"]:
-                writer.writerow([
-                    rec["invoice_id"],
-                    rec["pdf"],
-                    rec["pharmacy"],
-                    rec["date"],
-                    rec["doctor"],
-                    item["brand"],
-                    item["generic"],
-                    item["strength"],
-                    item["batch"],
-                    item["qty"],
-                    f"{item['price']:.2f}",
-                    item["gst"],
-                    f"{item['line_total']:.2f}",
-                    item["is_banned"]
-                ])
+    # orjson emits UTF-8 bytes directly (no ensure_ascii escaping)
+    with open(json_path, "wb") as jf:
+        jf.write(orjson.dumps(records, option=orjson.OPT_INDENT_2))
+
+    rows = [CSV_HEADER]
+    rows.extend(
+        [
+            rec["invoice_id"],
+            rec["pdf"],
+            rec["pharmacy"],
+            rec["date"],
+            rec["doctor"],
+            item["brand"],
+            item["generic"],
+            item["strength"],
+            item["batch"],
+            item["qty"],
+            f"{item['price']:.2f}",
+            item["gst"],
+            f"{item['line_total']:.2f}",
+            item["is_banned"]
+        ]
+        for rec in records
+        for item in rec["items"]
+    )
+
+    # Serialize in memory, then hit the file with a single write
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+
+    with open(csv_path, "w", newline="", encoding="utf-8") as cf:
+        cf.write(buf.getvalue())
 
 # ------------------ MAIN ------------------
 def main():
-    print("Generating TRAIN dataset...")
-    train_records = [generate_invoice(f"TRAIN-{i+1:04d}", TRAIN_DIR) for i in range(NUM_TRAIN)]
-    save_dataset(train_records, TRAIN_DIR, "train_dataset")
+    # Done here rather than at import so pool workers never wipe the output
+    if os.path.exists(OUT_DIR):
+        shutil.rmtree(OUT_DIR)
+
+    os.makedirs(TRAIN_DIR, exist_ok=True)
+    os.makedirs(TEST_DIR, exist_ok=True)
+
+    # Values are drawn up front in this process, so pool scheduling never
+    # affects the output; workers only render the PDFs
+    train_rng, test_rng = (np.random.default_rng(s) for s in np.random.SeedSequence(SEED).spawn(2))
+
+    with Pool() as pool:
+        print("Generating TRAIN dataset...")
+        train_records = pool.starmap(generate_invoice, sample_invoices("TRAIN", NUM_TRAIN, TRAIN_DIR, train_rng))
+        save_dataset(train_records, TRAIN_DIR, "train_dataset")
 
-    print("Generating TEST dataset...")
-    test_records = [generate_invoice(f"TEST-{i+1:04d}", TEST_DIR) for i in range(NUM_TEST)]
-    save_dataset(test_records, TEST_DIR, "test_dataset")
+        print("Generating TEST dataset...")
+        test_records = pool.starmap(generate_invoice, sample_invoices("TEST", NUM_TEST, TEST_DIR, test_rng))
+        save_dataset(test_records, TEST_DIR, "test_dataset")
 
     print("\nDataset generation completed!")
     print("Output folder:", os.path.abspath(OUT_DIR))
@@ -1,13 +1,55 @@
 # ocr_matcher.py
 import os
-import re
 import csv
-from pdf2image import convert_from_path
-import pytesseract
-from rapidfuzz import fuzz
+import math
+import pickle
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import ahocorasick
+import fitz  # PyMuPDF
+from PIL import Image
+from tesserocr import PyTessBaseAPI, OEM, PSM
+from rapidfuzz import fuzz, process
 
 # ---------------- CONFIG ----------------
-POPPLER_PATH = os.getenv("POPPLER_PATH")
+OCR_DPI = 150
+
+# Tesseract runtime is roughly linear in pixel count; pages are downsampled
+# to at most this many pixels before OCR. The default fits letter and A4 at
+# OCR_DPI, so it only shrinks oversized pages and photos. Lowering it trades
+# accuracy for speed: below ~150 dpi body text gets too small for reliable
+# OCR (800k px puts a letter page at ~92 dpi, 10pt glyphs ~13 px tall).
+OCR_MAX_PIXELS = int(os.getenv("OCR_MAX_PIXELS", "2200000"))
+
+# LSTM engine only, one uniform text block, and only the characters that
+# appear on invoices: "+" is part of combination generics such as
+# "Codeine + CPM", "%" and "#" are in the item table header
+OCR_OEM = OEM.LSTM_ONLY
+OCR_PSM = PSM.SINGLE_BLOCK
+OCR_CHAR_WHITELIST = (
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 /-.,:+%#"
+)
+# Part of every segment cache key, so changing OCR settings invalidates it
+OCR_SETTINGS = f"eng|oem={int(OCR_OEM)}|psm={int(OCR_PSM)}|{OCR_CHAR_WHITELIST}"
+
+# Processes in the OCR pool (and rapidfuzz threads) per web worker. Every
+# gunicorn worker has its own pool, so the cores are split between them.
+OCR_WORKERS = int(os.getenv(
+    "OCR_WORKERS",
+    max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1")))
+))
+
+# Pages with less extractable text than this are treated as scanned and OCR'd
+MIN_TEXT_CHARS = 50
+
+# Pages whose images cover at least this share of the page are scans and
+# are OCR'd even if they carry a text overlay (watermark, stamp, scanner OCR)
+SCAN_IMAGE_COVERAGE = 0.5
 
 # Canonical banned generics (lowercase)
 BANNED_KEYWORDS = {
@@ -15,30 +57,287 @@ BANNED_KEYWORDS = {
 }
 
 FUZZY_THRESHOLD = 85
+
+# Number of distinct uploads whose OCR text is kept in memory
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "128"))
+
+# Scanned pages are OCR'd as horizontal bands cached on disk by pixel hash,
+# so boilerplate shared across invoices (header, signature) is OCR'd once
+OCR_BANDS = 6
+BLANK_LEVEL = 245  # grayscale rows at least this light count as blank
+SEGMENT_CACHE_PATH = os.getenv(
+    "OCR_SEGMENT_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads", ".ocr_cache", "segments.sqlite3")
+)
+SEGMENT_CACHE_MAX_ROWS = int(os.getenv("OCR_SEGMENT_CACHE_SIZE", "50000"))
 # --------------------------------------
 
 
-def pdf_to_images(pdf_path):
-    if POPPLER_PATH:
-        return convert_from_path(pdf_path, dpi=200, poppler_path=POPPLER_PATH)
-    return convert_from_path(pdf_path, dpi=200)
+def open_pdf(pdf_bytes):
+    return fitz.open(stream=pdf_bytes, filetype="pdf")
+
+
+def page_to_image(page):
+    # Render straight at the budgeted resolution instead of resizing later
+    area_in2 = (page.rect.width / 72) * (page.rect.height / 72)
+    dpi = min(OCR_DPI, int(math.sqrt(OCR_MAX_PIXELS / area_in2)))
+    return page.get_pixmap(dpi=dpi).pil_image()
+
+
+def fit_pixel_budget(image):
+    w, h = image.size
+    scale = min(1.0, math.sqrt(OCR_MAX_PIXELS / (w * h)))
+    if scale >= 1.0:
+        return image
+    return image.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+
+
+# One Tesseract handle per process keeps the LSTM model loaded between
+# pages. The API is not thread-safe, so calls are serialized; the OCR pool
+# gives each worker process its own handle for parallelism.
+_TESS_API = None
+_TESS_API_LOCK = threading.Lock()
+
+
+def _tess_api():
+    global _TESS_API
+    if _TESS_API is None or _TESS_API[0] != os.getpid():
+        api = PyTessBaseAPI(lang="eng", oem=OCR_OEM, psm=OCR_PSM)
+        api.SetVariable("tessedit_char_whitelist", OCR_CHAR_WHITELIST)
+        _TESS_API = (os.getpid(), api)
+    return _TESS_API[1]
 
 
 def ocr_image(image):
-    return pytesseract.image_to_string(image, lang="eng")
+    with _TESS_API_LOCK:
+        api = _tess_api()
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+
+def page_text_layer(page):
+    """
+    Returns the page's extractable text, or None if the page must be OCR'd
+    """
+    text = page.get_text("text")
+    if len(text.strip()) < MIN_TEXT_CHARS:
+        return None
+
+    page_area = abs(page.rect)
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    if page_area and image_area / page_area >= SCAN_IMAGE_COVERAGE:
+        return None
+
+    return text
+
+
+# ---------------- SEGMENT CACHE ----------------
+# SQLite rather than shelve: OCR pool workers write to it concurrently.
+# One connection per process, reopened after fork.
+_SEGMENT_DB = None
+_SEGMENT_DB_LOCK = threading.Lock()
+
+
+def _segment_db():
+    global _SEGMENT_DB
+    if _SEGMENT_DB is None or _SEGMENT_DB[0] != os.getpid():
+        os.makedirs(os.path.dirname(SEGMENT_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(SEGMENT_CACHE_PATH, timeout=30, check_same_thread=False)
+        conn.execute("CREATE TABLE IF NOT EXISTS segments (hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+        conn.commit()
+        _SEGMENT_DB = (os.getpid(), conn)
+    return _SEGMENT_DB[1]
+
+
+def _is_blank_row(gray, y):
+    return gray.crop((0, y, gray.width, y + 1)).getextrema()[0] >= BLANK_LEVEL
+
+
+def _band_bounds(gray, n_bands):
+    """
+    Splits the page into n_bands horizontal bands, nudging each cut to the
+    nearest blank row so no text line is sliced in half
+    """
+    height = gray.height
+    reach = max(1, height // (2 * n_bands))
+    bounds = [0]
+
+    for i in range(1, n_bands):
+        target = height * i // n_bands
+        cut = target
+        for dy in range(reach):
+            if _is_blank_row(gray, target - dy):
+                cut = target - dy
+                break
+            if target + dy < height and _is_blank_row(gray, target + dy):
+                cut = target + dy
+                break
+        if cut > bounds[-1]:
+            bounds.append(cut)
+
+    bounds.append(height)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _segment_key(band):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(OCR_SETTINGS.encode())
+    h.update(f"{band.width}x{band.height}".encode())
+    h.update(band.tobytes())
+    return h.hexdigest()
+
+
+def ocr_page_image(image):
+    gray = fit_pixel_budget(image).convert("L")
+    bands = [gray.crop((0, top, gray.width, bottom)) for top, bottom in _band_bounds(gray, OCR_BANDS)]
+    keys = [_segment_key(band) for band in bands]
+
+    with _SEGMENT_DB_LOCK:
+        db = _segment_db()
+        placeholders = ",".join("?" * len(keys))
+        cached = dict(db.execute(f"SELECT hash, text FROM segments WHERE hash IN ({placeholders})", keys))
+
+    misses = {}
+    for band, key in zip(bands, keys):
+        if key not in cached:
+            # Blank bands (margins, gaps) never need Tesseract
+            cached[key] = "" if band.getextrema()[0] >= BLANK_LEVEL else ocr_image(band).strip()
+            misses[key] = cached[key]
+
+    if misses:
+        with _SEGMENT_DB_LOCK:
+            db = _segment_db()
+            db.executemany("INSERT OR REPLACE INTO segments (hash, text) VALUES (?, ?)", misses.items())
+            # Keep only the newest SEGMENT_CACHE_MAX_ROWS entries (rowids grow
+            # with every insert, so the oldest rows go first)
+            db.execute(
+                "DELETE FROM segments WHERE rowid <= (SELECT MAX(rowid) FROM segments) - ?",
+                (SEGMENT_CACHE_MAX_ROWS,)
+            )
+            db.commit()
+
+    texts = [cached[key] for key in keys if cached[key]]
+    return "\n".join(texts)
+
+
+# ---------------- PARALLEL OCR ----------------
+# Created lazily so forked web workers each get their own pool and
+# importing this module never spawns processes. Workers come from a
+# forkserver (spawn where that is unavailable, e.g. Windows): the pool is
+# created inside a threaded web server, and a plain fork could copy a
+# Tesseract/segment-cache lock held by another request thread into the
+# child, where it would never be released.
+_OCR_POOL = None
+_OCR_POOL_LOCK = threading.Lock()
+
+
+def _ocr_pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _get_ocr_pool():
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None:
+            _OCR_POOL = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=_ocr_pool_context()
+            )
+        return _OCR_POOL
+
+
+def _discard_ocr_pool(pool):
+    # A crashed or OOM-killed worker breaks the whole executor; drop it so
+    # the next multi-page scan starts a fresh pool
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is pool:
+            _OCR_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _ocr_page(args):
+    # Workers receive the raw PDF bytes and rasterize their own page;
+    # pickling the bytes is far cheaper than pickling a PIL image.
+    pdf_bytes, page_index = args
+    with open_pdf(pdf_bytes) as doc:
+        return ocr_page_image(page_to_image(doc[page_index]))
+
+
+def ocr_pdf_text(pdf_bytes):
+    with open_pdf(pdf_bytes) as doc:
+        # -------- Born-digital fast path, decided per page --------
+        texts = [page_text_layer(page) for page in doc]
+        to_ocr = [i for i, text in enumerate(texts) if text is None]
 
+        # A single scanned page is the common case; skip the IPC round trip
+        if len(to_ocr) == 1:
+            texts[to_ocr[0]] = ocr_page_image(page_to_image(doc[to_ocr[0]]))
+            to_ocr = []
 
-def ocr_pdf_text(pdf_path):
-    images = pdf_to_images(pdf_path)
-    return [ocr_image(img) for img in images]
+    if to_ocr:
+        pool = _get_ocr_pool()
+        jobs = [(pdf_bytes, page_index) for page_index in to_ocr]
+        try:
+            for page_index, text in zip(to_ocr, pool.map(_ocr_page, jobs)):
+                texts[page_index] = text
+        except BrokenProcessPool:
+            _discard_ocr_pool(pool)
+            raise
+
+    return texts
+
+
+# ---------------- OCR CACHE ----------------
+# LRU of SHA-256(file bytes) -> OCR page texts, so re-uploading the same
+# invoice skips rasterization and Tesseract entirely.
+_OCR_CACHE = OrderedDict()
+_OCR_CACHE_LOCK = threading.Lock()
+
+
+def cached_ocr_pdf_text(pdf_bytes):
+    key = hashlib.sha256(pdf_bytes).hexdigest()
+
+    with _OCR_CACHE_LOCK:
+        texts = _OCR_CACHE.get(key)
+        if texts is not None:
+            _OCR_CACHE.move_to_end(key)
+            return list(texts)
+
+    texts = ocr_pdf_text(pdf_bytes)
+
+    with _OCR_CACHE_LOCK:
+        _OCR_CACHE[key] = tuple(texts)
+        while len(_OCR_CACHE) > OCR_CACHE_SIZE:
+            _OCR_CACHE.popitem(last=False)
+
+    return texts
 
 
 # ---------------- TEXT NORMALIZATION ----------------
+# Byte table for normalize(): A-Z -> a-z, a-z / 0-9 kept, everything else
+# (punctuation, whitespace, "?" standing in for non-ASCII) -> space
+_NORMALIZE_TABLE = bytes(
+    b + 32 if 65 <= b <= 90 else
+    b if 97 <= b <= 122 or 48 <= b <= 57 else
+    32
+    for b in range(256)
+)
+
+
+def normalize_bytes(data: bytes) -> str:
+    # Stays in bytes until the final decode: translate() is a branch-free
+    # table lookup per byte and bytes.split()/join never decode code points
+    return b" ".join(data.translate(_NORMALIZE_TABLE).split()).decode("ascii")
+
+
 def normalize(text: str) -> str:
-    text = text.lower()
-    text = re.sub(r"[^a-z0-9\s]", " ", text)
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    # Unicode lowercasing can map a non-ASCII char to ASCII (e.g. Kelvin K)
+    if not text.isascii():
+        text = text.lower()
+    return normalize_bytes(text.encode("ascii", "replace"))
 
 
 # ---------------- DATASET ----------------
@@ -59,54 +358,139 @@ def load_dataset_csv(csv_paths):
     return rows
 
 
-# ---------------- CORE MATCHER ----------------
-def find_banned_drugs_in_invoice(ocr_texts, dataset_rows):
+def load_banned_generics(csv_paths):
     """
-    Returns ONLY banned drugs actually present in the invoice
+    Returns unique (normalized, original) generic names for banned dataset
+    rows; the CSVs repeat each generic once per invoice line
     """
-
-    invoice_text = normalize("\n".join(ocr_texts))
-    found_banned = set()
-
-    for r in dataset_rows:
+    banned = set()
+    for r in load_dataset_csv(csv_paths):
         if not r["is_banned"]:
             continue
 
         generic = normalize(r["generic"])
-        if not generic:
-            continue
+        if generic:
+            banned.add((generic, r["generic"]))
+    return sorted(banned)
+
+
+def save_banned_generics_index(banned_generics, path):
+    """
+    Writes the deduplicated banned generics to a pickle so the web app can
+    skip parsing the dataset CSVs at startup
+    """
+    data = {
+        "banned": [original for _, original in banned_generics],
+        "normalized": [generic for generic, _ in banned_generics],
+    }
+    with open(path, "wb") as f:
+        pickle.dump(data, f, protocol=5)
+
+
+def load_banned_generics_index(path):
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    return list(zip(data["normalized"], data["banned"]))
 
-        # -------- Exact / substring match (preferred) --------
-        if generic in invoice_text:
-            found_banned.add(r["generic"])
-            continue
 
-        # -------- Fuzzy match fallback --------
-        score = fuzz.partial_ratio(generic, invoice_text)
-        if score >= FUZZY_THRESHOLD:
-            found_banned.add(r["generic"])
+def build_banned_index(banned_generics):
+    """
+    Builds an Aho-Corasick automaton over the normalized banned generics so
+    all exact matches are found in a single pass over the invoice text
+    """
+    # Spelling variants that normalize identically are matched once
+    originals = {}
+    for generic, original in banned_generics:
+        originals.setdefault(generic, []).append(original)
+
+    automaton = None
+    if originals:
+        automaton = ahocorasick.Automaton()
+        for generic in originals:
+            automaton.add_word(generic, generic)
+        automaton.make_automaton()
+
+    return {
+        "generics": originals,
+        "automaton": automaton
+    }
+
+
+# ---------------- CORE MATCHER ----------------
+def find_banned_drugs_in_invoices(invoices_ocr_texts, banned_index):
+    """
+    Batch form of find_banned_drugs_in_invoice: one result list per invoice,
+    with the fuzzy fallback for every invoice scored in a single cdist call
+    """
+
+    invoice_texts = [normalize("\n".join(ocr_texts)) for ocr_texts in invoices_ocr_texts]
+    originals = banned_index["generics"]
+    found_generics = [set() for _ in invoice_texts]
+
+    # -------- Exact / substring match (preferred) --------
+    automaton = banned_index["automaton"]
+    if automaton is not None:
+        for text, found in zip(invoice_texts, found_generics):
+            for _, generic in automaton.iter(text):
+                found.add(generic)
 
-    # -------- Safety net (hard keywords) --------
-    for kw in BANNED_KEYWORDS:
-        if kw in invoice_text:
-            found_banned.add(kw.capitalize())
+    # -------- Fuzzy match fallback --------
+    # Generics that at least one invoice did not match exactly
+    remaining = [g for g in originals if any(g not in found for found in found_generics)]
+    if remaining and invoice_texts:
+        # invoices x generics score matrix from one C++ call
+        scores = process.cdist(
+            invoice_texts,
+            remaining,
+            scorer=fuzz.partial_ratio,
+            score_cutoff=FUZZY_THRESHOLD,
+            workers=OCR_WORKERS
+        )
+        for found, row in zip(found_generics, scores):
+            for generic, score in zip(remaining, row):
+                if score >= FUZZY_THRESHOLD:
+                    found.add(generic)
 
-    return sorted(found_banned)
+    results = []
+    for text, found in zip(invoice_texts, found_generics):
+        found_banned = set()
+        for generic in found:
+            found_banned.update(originals[generic])
+
+        # -------- Safety net (hard keywords) --------
+        for kw in BANNED_KEYWORDS:
+            if kw in text:
+                found_banned.add(kw.capitalize())
+
+        results.append(sorted(found_banned))
+
+    return results
+
+
+def find_banned_drugs_in_invoice(ocr_texts, banned_index):
+    """
+    Returns ONLY banned drugs actually present in the invoice
+    """
+    return find_banned_drugs_in_invoices([ocr_texts], banned_index)[0]
 
 
 # ---------------- MAIN PIPELINE ----------------
-def process_invoice(pdf_path, dataset_csvs):
-    ocr_texts = ocr_pdf_text(pdf_path)
-    dataset_rows = load_dataset_csv(dataset_csvs)
+def process_invoice(pdf_path, banned_index):
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    return process_invoice_bytes(pdf_bytes, banned_index)
+
+
+def process_invoice_bytes(pdf_bytes, banned_index):
+    ocr_texts = cached_ocr_pdf_text(pdf_bytes)
 
     banned_found = find_banned_drugs_in_invoice(
         ocr_texts,
-        dataset_rows
+        banned_index
     )
 
     return {
         "ocr_text": "\n".join(ocr_texts),
         "banned_drugs": banned_found
     }
-
-